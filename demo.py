@@ -3,7 +3,7 @@ from typing import Tuple, List
 
 from mcts.base import MCTS
 from mcts.simple import init_mcts
-from mühle import GameState, PlayerID
+from mühle import GameState, PlayerID, repr_action
 
 
 def other(playerID: PlayerID):
@@ -16,19 +16,16 @@ def min_max_mcts(mcts: MCTS):
 
 
 def run_mcts(mcts: MCTS, timeout=1.0) -> int:
-    start = time.time()
-    end_timeout = start + timeout
+    deadline = time.monotonic() + timeout
 
     i = 0
-    while True:
-        if i > 10 and time.time() > end_timeout:
-            break
-
+    while mcts.run_one_iteration():
         i += 1
-        if not mcts.run_one_iteration():
+        # An iteration runs whole batches of rollouts, so the cheap monotonic clock is checked after every one
+        if time.monotonic() > deadline:
             break
 
-        #if len(mcts.node.children) > 100:
+        #if len(mcts.node.child_nodes) > 100:
         #    rew_min, rew_max = min_max_mcts(mcts)
         #    if rew_max > rew_min or rew_min > 0:
         #        break
@@ -54,11 +51,11 @@ if __name__ == "__main__":
         mcts_current: MCTS = players[player]
         print("MCTS iterations: %s" % run_mcts(mcts_current, timeout=4))
         action, node = mcts_current.select_best()
-        print(action)
+        print(repr_action(action, node.state.board.design))
 
         mcts_other: MCTS = players[other(player)]
         mcts_other.select_other(action, node.state)
-        if not mcts_other.node.children and not mcts_other.node.remaining_actions:
+        if not mcts_other.node.child_nodes and not mcts_other.node.remaining_actions:
             print("Player %s wins!" % player)
             break
 
@@ -0,0 +1,31 @@
+import random
+from typing import List, Optional, Tuple
+
+from mühle import GameState, np, numba, rollout_batch
+
+COMPILED = numba is not None
+RANDOM_BITS = 30
+
+
+def random_generator(seed: Optional[int] = None):
+    """The generator of random_buffer, a NumPy Generator if available."""
+    if np is None:
+        return random.Random(seed)
+    return np.random.default_rng(seed)
+
+
+def random_buffer(rng, rows: int, columns: int):
+    """Draws all random numbers of a batch of rollouts at once, one row per rollout and one column per step."""
+    if np is None:
+        return [[rng.getrandbits(RANDOM_BITS) for _ in range(columns)] for _ in range(rows)]
+    return rng.integers(0, 1 << RANDOM_BITS, size=(rows, columns))
+
+
+def rollout_state(state: GameState, steps: int, max_depth: int, rand) -> List[Tuple[int, int, int, int]]:
+    """Runs one rollout per row of random numbers from the state, see random_buffer."""
+    design = state.board.design
+    if not design.compiled and np is not None:
+        rand = rand.tolist()  # Python ints, the plain Python kernels mix them with large bitboards
+    return design.kernel(rollout_batch)(state.board.bb[0], state.board.bb[1], state.player_turn.playerID,
+                                        state.placed_items[0], state.placed_items[1], state.max_placed_items,
+                                        steps, max_depth, rand, *design.kernel_tables)
@@ -1,12 +1,22 @@
 import random
+import threading
+import time
 from abc import abstractmethod, ABC
+from array import array
 from enum import Enum
 from typing import Dict, Set, Iterator, TypeVar, Generic, NamedTuple, Tuple, List, Optional
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 from mühle import Action, GameState, PlayerID
 
 T = TypeVar('T')
 
+VIRTUAL_LOSS = 1
+
 
 class SelectionPolicy(ABC):
     @abstractmethod
@@ -16,34 +26,76 @@ class SelectionPolicy(ABC):
 
 class ExpansionPolicy(ABC):
     @abstractmethod
-    def expand(self, node: 'MCTS_Node') -> Iterator['MCTS_Node']:
+    def expand(self, node: 'MCTS_Node', table: Dict[int, 'MCTS_Node']) -> Iterator['MCTS_Node']:
         ...
 
 
 class SimulationPolicy(ABC):
     @abstractmethod
-    def simulate(self, node: 'MCTS_Node'):
+    def calc_reward(self, node: 'MCTS_Node') -> float:
+        """Simulates the game from the node, must not modify the tree."""
         ...
 
+    def simulate(self, node: 'MCTS_Node') -> float:
+        """Adds one simulation to the node and returns its reward."""
+        reward = self.calc_reward(node)
+        node.add_simulation(reward)
+        return reward
+
 
 class BackpropagationPolicy(ABC):
     @abstractmethod
-    def backpropagate(self, node: 'MCTS_Node'):
+    def backpropagate(self, node: 'MCTS_Node', simulations: int, reward_total: float):
+        """Propagates new simulations of the node to its ancestors."""
         ...
 
 
+def zeros(typecode: str, size: int):
+    """Zero filled statistics array, a NumPy array if available."""
+    if np is None:
+        return array(typecode, bytes(size * array(typecode).itemsize))
+    return np.zeros(size, dtype=np.float64 if typecode == 'd' else np.int64)
+
+
 class MCTS_Node:
-    def __init__(self, state: GameState, parent: Optional['MCTS_Node'] = None) -> None:
+    __slots__ = ('state', 'parent', 'index_in_parent', 'remaining_actions', 'actions', 'child_nodes',
+                 'child_rewards', 'child_sims', 'child_visited', 'visited', 'simulations', 'reward_total')
+
+    def __init__(self, state: GameState) -> None:
         self.state = state
         state.freeze()
-        self.parent = parent
+        # Transpositions let a node have many parents, this is the parent of the most recent path through it.
+        # It is set together with the index in the parent by add_child and the selection.
+        self.parent: Optional[MCTS_Node] = None
+        self.index_in_parent: int = -1
         self.remaining_actions: List[Action] = list(state.calc_available_actions())
-        self.children: Dict[Action, MCTS_Node] = dict()
 
+        # Statistics of the children in parallel arrays, indexed by the order of expansion.
+        # Each child gets at most one slot per remaining action.
+        size = len(self.remaining_actions)
+        self.actions: List[Action] = []
+        self.child_nodes: List[MCTS_Node] = []
+        self.child_rewards = zeros('d', size)
+        self.child_sims = zeros('d', size)
+        self.child_visited = zeros('q', size)
+
+        # Statistics of the node itself, used for the root and nodes shared by transposition
         self.visited: int = 0
         self.simulations: int = 0
         self.reward_total: float = 0.0
 
+    def add_simulation(self, reward: float):
+        self.reward_total += reward
+        self.simulations += 1
+
+    def add_child(self, action: Action, child: 'MCTS_Node') -> int:
+        index = len(self.child_nodes)
+        self.actions.append(action)
+        self.child_nodes.append(child)
+        child.parent = self
+        child.index_in_parent = index
+        return index
+
 
 class MCTS:
     def __init__(
@@ -55,6 +107,8 @@ class MCTS:
             propagation: BackpropagationPolicy
     ):
         self.node: MCTS_Node = MCTS_Node(root)
+        # Transposition table of all nodes by their state key
+        self.tt: Dict[int, MCTS_Node] = {root.state_key(): self.node}
         self.selection = selection
         self.expansion = expansion
         self.simulation = simulation
@@ -63,20 +117,101 @@ class MCTS:
     def run_one_iteration(self):
         node = self.selection.select_from(self.node)
         if node:
-            for child in self.expansion.expand(node):
-                self.simulation.simulate(child)
-                self.propagation.backpropagate(child)
+            for child in self.expansion.expand(node, self.tt):
+                reward = self.simulation.simulate(child)
+                self.propagation.backpropagate(child, 1, reward)
             return True
         return False
 
+    def run_parallel(self, n_threads: int, timeout: float) -> int:
+        """
+        Runs iterations in n_threads worker threads until the timeout in seconds, returns the number of iterations.
+        The tree is only changed under a single lock, the simulations run outside of it.
+        """
+        assert n_threads > 0
+        lock = threading.Lock()
+        deadline = time.monotonic() + timeout
+        stop = threading.Event()
+        errors: List[BaseException] = []
+        iterations = [0] * n_threads
+        workers = [threading.Thread(target=self._run_worker, args=(lock, deadline, stop, errors, iterations, n))
+                   for n in range(n_threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise errors[0]
+        return sum(iterations)
+
+    def _run_worker(self, lock: threading.Lock, deadline: float, stop: threading.Event, errors: List[BaseException],
+                    iterations: List[int], n: int):
+        try:
+            while not stop.is_set() and time.monotonic() < deadline:
+                if not self._run_parallel_iteration(lock):
+                    return
+                iterations[n] += 1
+        except BaseException as e:
+            # Stops the other workers too, run_parallel raises it again
+            errors.append(e)
+            stop.set()
+
+    def _run_parallel_iteration(self, lock: threading.Lock) -> bool:
+        with lock:
+            node = self.selection.select_from(self.node)
+            if node is None:
+                return False
+            children = list(self.expansion.expand(node, self.tt))
+            # Parents can be re-pointed by other workers, so the paths are recorded
+            paths = [self._record_path(child) for child in children]
+            for path in paths:
+                self._add_virtual_loss(path, VIRTUAL_LOSS)
+
+        rewards = None
+        try:
+            rewards = [self.simulation.calc_reward(child) for child in children]
+        finally:
+            with lock:
+                for path in paths:
+                    self._add_virtual_loss(path, -VIRTUAL_LOSS)
+                if rewards is not None:
+                    for child, path, reward in zip(children, paths, rewards):
+                        self._restore_path(child, path)
+                        child.add_simulation(reward)
+                        self.propagation.backpropagate(child, 1, reward)
+        return True
+
+    @staticmethod
+    def _record_path(node: MCTS_Node) -> List[Tuple[MCTS_Node, int]]:
+        path = []
+        while node.parent is not None:
+            path.append((node.parent, node.index_in_parent))
+            node = node.parent
+        return path
+
+    @staticmethod
+    def _restore_path(node: MCTS_Node, path: List[Tuple[MCTS_Node, int]]):
+        for parent, index in path:
+            node.parent = parent
+            node.index_in_parent = index
+            node = parent
+
+    @staticmethod
+    def _add_virtual_loss(path: List[Tuple[MCTS_Node, int]], loss: int):
+        # Counts a lost simulation along the path, so that other workers choose different paths
+        for parent, index in path:
+            parent.child_sims[index] += loss
+            parent.child_rewards[index] -= loss
+            parent.simulations += loss
+            parent.reward_total -= loss
+
     def calc_action_rewards(self) -> List[Tuple[float, Action, MCTS_Node]]:
-        assert self.node.children
-        return list((c.reward_total / c.simulations, a, c) for a, c in self.node.children.items())
+        node = self.node
+        rewards, sims = node.child_rewards, node.child_sims
+        return [(rewards[i] / sims[i], a, c) for i, (a, c) in enumerate(zip(node.actions, node.child_nodes))]
 
     def calc_best_action(self) -> Tuple[float, Action, MCTS_Node]:
-        children = self.calc_action_rewards()
-        children.sort(key=lambda e: e[0], reverse=True)
-        return children[0]
+        return max(self.calc_action_rewards(), key=lambda e: e[0])
 
     def select_best(self) -> Tuple[Action, MCTS_Node]:
         reward, action, child = self.calc_best_action()
@@ -84,13 +219,23 @@ class MCTS:
         # Set as current new node
         self.node = child
         self.node.parent = None  # Stop backpropagation to old roots
+        self.node.index_in_parent = -1
+        self._prune_table()
 
         return action, child
 
     def select_other(self, action: Action, game: GameState):
         # Try to use already pre-computed nodes...
-        if action in self.node.children:
-            self.node = self.node.children[action]
-            self.node.parent = None
+        if action in self.node.actions:
+            self.node = self.node.child_nodes[self.node.actions.index(action)]
         else:
-            self.node = MCTS_Node(game)
+            self.node = self.tt.get(game.state_key(), None) or MCTS_Node(game)
+        self.node.parent = None
+        self.node.index_in_parent = -1
+        self._prune_table()
+
+    def _prune_table(self):
+        # Nodes of earlier plies are unreachable from the new root
+        ply = self.node.state.ply
+        self.tt = {key: node for key, node in self.tt.items() if node.state.ply > ply}
+        self.tt[self.node.state.state_key()] = self.node
@@ -1,9 +1,10 @@
 import math
 import random
-from typing import Iterator, List, Tuple, Optional, NamedTuple, TypeVar
+from typing import Dict, Iterator, List, Tuple, Optional, NamedTuple, TypeVar
 
-from mcts.base import SimulationPolicy, MCTS_Node, SelectionPolicy, BackpropagationPolicy, ExpansionPolicy, MCTS
-from mühle import Action, GameState, PlayerID
+from mcts._rollout_nb import COMPILED, random_buffer, random_generator, rollout_state
+from mcts.base import np, SimulationPolicy, MCTS_Node, SelectionPolicy, BackpropagationPolicy, ExpansionPolicy, MCTS
+from mühle import Action, GameState, PlayerID, action_attacks
 
 T = TypeVar('T')
 
@@ -22,15 +23,25 @@ class SimulationResult(NamedTuple):
 
 
 class SimpleSimulationPolicy(SimulationPolicy):
-    def __init__(self, player: PlayerID, max_depth=50, branching=5, branching_depth=1):
+    # Rollouts per branch, batching only pays off when the rollout kernel is compiled
+    batch = 32 if COMPILED else 1
+
+    def __init__(self, player: PlayerID, max_depth=50, branching=5, branching_depth=1, batch: Optional[int] = None,
+                 seed: Optional[int] = None):
         self.player = player
         self.max_depth = max_depth
         self.branching = branching
         self.branching_depth = branching_depth
-
-    def simulate(self, node: MCTS_Node):
+        if batch is not None:
+            assert batch > 0
+            self.batch = batch
+        # Without a seed it is drawn from the random module, so the search stays reproducible with random.seed
+        self.rng = random_generator(random.getrandbits(64) if seed is None else seed)
+
+    def calc_reward(self, node: MCTS_Node) -> float:
+        actions = list(node.state.calc_available_actions())  # Cached by the frozen node state
         state = node.state.clone()
-        results = list(self._iter_simulate(state, list(state.calc_available_actions())))
+        results = list(self._iter_simulate(state, actions))
 
         other_player = state.other(self.player).playerID
 
@@ -51,12 +62,11 @@ class SimpleSimulationPolicy(SimulationPolicy):
             else:  # We lost the game
                 reward -= 1.0
             """
-        node.reward_total += reward / len(results)
-        node.simulations += 1
+        return reward / len(results)
 
     def take_action(self, actions: List[Action]) -> Action:
         assert actions
-        actions_with_attack = list((n, a) for n, a in enumerate(actions) if a.attacks)
+        actions_with_attack = list((n, a) for n, a in enumerate(actions) if action_attacks(a))
         if actions_with_attack:
             index, action = pop_random_from_list(actions_with_attack)
             del actions[index]
@@ -65,43 +75,46 @@ class SimpleSimulationPolicy(SimulationPolicy):
             return pop_random_from_list(actions)
 
     def _iter_simulate(self, state: GameState, actions: List[Action], steps: int = 0):
-        if steps >= self.max_depth:
-            yield SimulationResult(steps, winner=None, pieces_left=state.board.count_total())
-        elif not actions:
-            yield SimulationResult(steps, winner=state.other(state.player_turn).playerID,
-                                   pieces_left=state.board.count_total())
-        else:
-            if self.branching > 1 and steps < self.branching_depth:
-                for n in range(0, min(self.branching, len(actions))):
-                    action = self.take_action(actions)
-                    newstate = state.clone()
-                    newstate.execute(action)
-                    yield from self._iter_simulate(newstate, list(newstate.calc_available_actions()), steps + 1)
-            else:
+        if self.branching > 1 and steps < self.branching_depth and steps < self.max_depth and actions:
+            # Branches share the state, each branch action is undone after its rollout
+            for n in range(0, min(self.branching, len(actions))):
                 action = self.take_action(actions)
                 state.execute(action)
                 yield from self._iter_simulate(state, list(state.calc_available_actions()), steps + 1)
+                state.undo()
+        else:
+            yield from self._iter_rollouts(state, steps)
 
+    def _iter_rollouts(self, state: GameState, steps: int) -> Iterator[SimulationResult]:
+        rand = random_buffer(self.rng, self.batch, self.max_depth)
+        for steps, winner, pieces0, pieces1 in rollout_state(state, steps, self.max_depth, rand):
+            yield SimulationResult(steps, winner=winner if winner >= 0 else None, pieces_left=(pieces0, pieces1))
 
-# UCB1
-def UCB1(node: MCTS_Node, ln_simulations_total):
-    #print(node.reward_total / node.simulations, math.sqrt(2 * ln_simulations_total / node.simulations))
-    return node.reward_total / node.simulations + math.sqrt(2 * ln_simulations_total / node.simulations)
+
+SQRT2 = math.sqrt(2.0)
 
 
 class SimpleSelectionPolicy(SelectionPolicy):
     def select_from(self, node: MCTS_Node) -> Optional[MCTS_Node]:
-        if node.remaining_actions:  # Not fully expanded
-            return node
-        else:
-            if node.children:
-                ln_simulations_total = math.log(node.simulations)
-                children = list((UCB1(child, ln_simulations_total), child) for action, child in node.children.items())
-                children.sort(key=lambda e: e[0], reverse=True)
-                ucb1_result, best = children[0]
-                return self.select_from(best)
-            else:
+        while not node.remaining_actions:  # Fully expanded
+            if not node.child_nodes:
                 return None  # Terminal node
+            ln_simulations_total = math.log(node.simulations)
+            n = len(node.child_nodes)
+            rewards, sims = node.child_rewards, node.child_sims
+            # UCB1 over the statistics arrays of all children
+            if np is None:
+                sqrt = math.sqrt
+                index = max(range(n), key=lambda i: rewards[i] / sims[i] + SQRT2 * sqrt(ln_simulations_total / sims[i]))
+            else:
+                sims = sims[:n]
+                index = int(np.argmax(rewards[:n] / sims + SQRT2 * np.sqrt(ln_simulations_total / sims)))
+            best = node.child_nodes[index]
+            # Backpropagate along the selected path
+            best.parent = node
+            best.index_in_parent = index
+            node = best
+        return node
 
 
 class SimpleExpansionPolicy(ExpansionPolicy):
@@ -109,25 +122,34 @@ class SimpleExpansionPolicy(ExpansionPolicy):
         assert branching > 0
         self.branching = branching
 
-    def expand(self, node: MCTS_Node) -> Iterator[MCTS_Node]:
+    def expand(self, node: MCTS_Node, table: Dict[int, MCTS_Node]) -> Iterator[MCTS_Node]:
         assert node.remaining_actions
         for _ in range(0, min(self.branching, len(node.remaining_actions))):
             action = pop_random_from_list(node.remaining_actions)
             newstate = node.state.clone()
             newstate.execute(action)
-            child = MCTS_Node(newstate, parent=node)
-            node.children[action] = child
+            key = newstate.state_key()
+            child = table.get(key, None)
+            if child is None:
+                child = MCTS_Node(newstate)
+                table[key] = child
+            # On a transposition the known node and its statistics are shared
+            node.add_child(action, child)
             yield child
 
 
 class SimpleBackpropagationPolicy(BackpropagationPolicy):
-    def backpropagate(self, node: MCTS_Node):
-        if node.parent:
-            parent = node.parent
-            parent.simulations += node.simulations
-            parent.reward_total += node.reward_total
+    def backpropagate(self, node: MCTS_Node, simulations: int, reward_total: float):
+        parent = node.parent
+        while parent is not None:
+            index = node.index_in_parent
+            parent.child_sims[index] += simulations
+            parent.child_rewards[index] += reward_total
+            parent.child_visited[index] += 1
+            parent.simulations += simulations
+            parent.reward_total += reward_total
             parent.visited += 1
-            self.backpropagate(parent)
+            node, parent = parent, parent.parent
 
 
 def init_mcts(game: GameState, playerID: PlayerID) -> MCTS:
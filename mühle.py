@@ -1,38 +1,121 @@
 import itertools
 import random
+import types
 from abc import ABC, abstractmethod
-from collections import defaultdict
-from enum import Enum
-from typing import Tuple, NewType, List, Optional, Dict, Iterator, TypeVar, Generic, Type, Union
+from array import array
+from typing import Tuple, NewType, List, Optional, Dict, Iterable, Iterator, TypeVar, Generic, Union
+
+try:
+    import numba
+    import numpy as np
+except ImportError:  # Optional, the integer kernels then run as plain Python
+    numba = None
+    np = None
 
 PlayerID = int
 
 
+def njit(func):
+    # Compiles an integer-only kernel in nopython mode if numba is installed.
+    # Numba only invalidates a cached kernel when its own file changes, so all kernels calling each other have to
+    # live in this module, or an edit of a called kernel leaves stale machine code in the cache.
+    if numba is None:
+        return func
+    return numba.njit(cache=True, nogil=True)(func)
+
+
+# Compiled kernels work on int64 values, so the packed actions and bitboards have to fit into 63 bits
+KERNEL_BITS = 63
+
+_python_kernels = dict()
+_python_namespaces = dict()
+
+
+def _python_namespace(module_globals: dict) -> dict:
+    # Globals of a module with its kernels replaced by their plain Python versions
+    namespace = _python_namespaces.get(id(module_globals), None)
+    if namespace is None:
+        namespace = _python_namespaces[id(module_globals)] = dict(module_globals)
+        for name, value in module_globals.items():
+            if isinstance(value, numba.core.dispatcher.Dispatcher):
+                namespace[name] = python_kernel(value)
+    return namespace
+
+
+def python_kernel(kernel):
+    """
+    The plain Python version of a kernel, calling the plain Python versions of other kernels.
+    It works on Python ints, so it also runs boards that are too large for the compiled kernels.
+    """
+    if numba is None:
+        return kernel
+    if kernel not in _python_kernels:
+        py_func = kernel.py_func
+        namespace = _python_namespace(py_func.__globals__)
+        if kernel not in _python_kernels:  # Not yet created while filling the namespace
+            _python_kernels[kernel] = types.FunctionType(py_func.__code__, namespace, py_func.__name__,
+                                                         py_func.__defaults__)
+    return _python_kernels[kernel]
+
+
+def kernel_array(values: list):
+    return list(values) if np is None else np.array(values, dtype=np.int64)
+
+
 class Player:
     def __init__(self, playerID: PlayerID):
         self.playerID = playerID
 
 
 class Piece:
+    __slots__ = ('_playerID',)
+
     def __init__(self, playerID: PlayerID):
-        self.playerID = playerID
+        self._playerID = playerID
+
+    @property
+    def playerID(self) -> PlayerID:
+        return self._playerID
+
+
+# Pieces are never changed, so all boards share one piece per player
+PIECES = (Piece(0), Piece(1))
 
 
 P = TypeVar('P', bound='Position')
 
 
+def iter_bits(bb: int) -> Iterator[int]:
+    while bb:
+        low = bb & -bb
+        yield low.bit_length() - 1
+        bb ^= low
+
+
 class Position:
-    def __init__(self, ring: int, index: int):
-        self.ring = ring
-        self.index = index
+    __slots__ = ('ring', 'index', '_hash')
+    # All positions are interned, so equal positions are the same object
+    _pool: Dict[Tuple[int, int], 'Position'] = dict()
+
+    def __new__(cls, ring: int, index: int):
+        pos = cls._pool.get((ring, index), None)
+        if pos is None:
+            new = super().__new__(cls)
+            new.ring = ring
+            new.index = index
+            new._hash = hash((ring, index))
+            # Atomic, so threads racing here still all get the same instance
+            pos = cls._pool.setdefault((ring, index), new)
+        return pos
+
+    def __reduce__(self):
+        return Position, (self.ring, self.index)
 
     def __hash__(self):
-        return hash((self.ring, self.index))
+        return self._hash
 
     def __eq__(self, other):
-        if isinstance(other, Position):
-            return self.ring == other.ring and self.index == other.index
-        return False
+        return self is other
 
     def __repr__(self):
         return "Pos(%s)" % self.__str__()
@@ -42,6 +125,28 @@ class Position:
 
 
 class BoardDesign(ABC):
+    # Precomputed bitboard tables, a field is addressed by its bit (see bit_of)
+    full_mask: int
+    mill_masks: List[int]
+    neighbor_masks: List[int]
+    lines_of_masks: List[List[int]]
+    mill_area_masks: List[int]  # Fields whose mill state can change with the field
+    mill_area_lines: List[List[int]]  # Line masks touching the mill area
+    zobrist: List[Tuple[int, int]]  # Random hash key per field bit and player
+    kernel_tables: tuple  # Full mask, mill masks, neighbor masks and padded lines of masks for the integer kernels
+    compiled: bool  # Whether the compiled kernels can be used, see kernel
+
+    @abstractmethod
+    def bit_of(self, pos: Position) -> int:
+        ...
+
+    @abstractmethod
+    def pos_of(self, bit: int) -> Position:
+        ...
+
+    def kernel(self, kernel):
+        """The compiled kernel, or its plain Python version if the design is too large for it."""
+        return kernel if self.compiled else python_kernel(kernel)
 
     @abstractmethod
     def distance_between(self, a: Position, b: Position) -> Tuple[int, int]:
@@ -56,7 +161,7 @@ class BoardDesign(ABC):
         ...
 
     @abstractmethod
-    def neighbors_of(self, pos: Position) -> Iterator[Position]:
+    def neighbors_of(self, pos: Position) -> Iterable[Position]:
         ...
 
     @abstractmethod
@@ -76,6 +181,16 @@ class BoardDesign(ABC):
         ...
 
 
+@njit
+def _is_linked(adj, a, b):
+    return (adj[a] >> b) & 1
+
+
+@njit
+def _third_in_line(line, n, first, second):
+    return line[first * n + second]
+
+
 class DefaultBoardDesign(BoardDesign):
     def __init__(self, sides=4, extended=False):
         assert sides >= 3
@@ -83,309 +198,674 @@ class DefaultBoardDesign(BoardDesign):
         self.ring_size = 2 * sides
         self.extended = extended
 
+        # Canonical positions, indexed by field bit
+        self._positions: List[Position] = [Position(ring, index)
+                                           for ring in range(0, 3) for index in range(0, self.ring_size)]
+        bit_of = self.bit_of
+
+        # Lookup tables of field bits
+        self._lines: List[Tuple[int, int, int]] = [
+            (bit_of(a), bit_of(b), bit_of(c)) for a, b, c in self._compute_lines()
+        ]
+        self._neighbors: Tuple[Tuple[Position, ...], ...] = tuple(
+            tuple(self._compute_neighbors_of(pos)) for pos in self._positions
+        )
+        self._neighbors_ids: Tuple[Tuple[int, ...], ...] = tuple(
+            tuple(bit_of(n) for n in neighbors) for neighbors in self._neighbors
+        )
+        self._lines_of: List[Tuple[Tuple[int, int], ...]] = [
+            tuple((bit_of(a), bit_of(b)) for a, b in self._compute_lines_of(pos)) for pos in self._positions
+        ]
+        # Adjacency bitboard per field bit, a link is a single bit test
+        # Python ints, so boards of any size fit
+        self._adj: List[int] = [0] * len(self._positions)
+        for a, neighbors in enumerate(self._neighbors_ids):
+            for b in neighbors:
+                self._adj[a] |= 1 << b
+                self._adj[b] |= 1 << a
+        # Third field bit of the line through each ordered pair of field bits, -1 if they are not in a line
+        n = len(self._positions)
+        self._line = array('h', [-1] * (n * n))
+        for line in self._lines:
+            for first, second, third in itertools.permutations(line):
+                self._line[first * n + second] = third
+
+        self.full_mask = (1 << len(self._positions)) - 1
+        self.mill_masks = [(1 << a) | (1 << b) | (1 << c) for a, b, c in self._lines]
+        self.neighbor_masks = list(self._adj)
+        # Compiled kernels only if the packed actions of the design fit into their int64 values
+        self.compiled = numba is not None and ACTION_ATTACKS_SHIFT + len(self._positions) <= KERNEL_BITS
+        if self.compiled:
+            # As NumPy arrays the tables can be passed to the compiled cores. Signed like the other kernel tables,
+            # since numba turns mixed signed/unsigned 64 bit arithmetic into floats.
+            self._adj = np.array(self._adj, dtype=np.int64)
+            self._line = np.array(self._line, dtype=np.int16)
+        self.lines_of_masks = [[(1 << a) | (1 << b) for a, b in lines] for lines in self._lines_of]
+        self.mill_area_masks = [(1 << bit) | sum(masks) for bit, masks in enumerate(self.lines_of_masks)]
+        self.mill_area_lines = [[mask for mask in self.mill_masks if mask & area] for area in self.mill_area_masks]
+
+        # Lines of a field are padded with -1, which never matches any pieces
+        width = max(len(masks) for masks in self.lines_of_masks)
+        table = kernel_array if self.compiled else list
+        self.kernel_tables = (self.full_mask, table(self.mill_masks), table(self.neighbor_masks),
+                              table([masks + [-1] * (width - len(masks)) for masks in self.lines_of_masks]))
+
+        rand = random.Random(len(self._positions))  # Same keys for every design of the same size
+        self.zobrist = [(rand.getrandbits(64), rand.getrandbits(64)) for _ in self._positions]
+
+    def bit_of(self, pos: Position) -> int:
+        return pos.ring * self.ring_size + pos.index
+
+    def pos_of(self, bit: int) -> Position:
+        return self._positions[bit]
+
+    # The packed integer id of a position is its field bit
+    id = bit_of
+    pos = pos_of
+
+    def P(self, ring: int, index: int) -> Position:
+        """The interned position of the field."""
+        return self._positions[ring * self.ring_size + index]
+
     def distance_between(self, a: Position, b: Position) -> Tuple[int, int]:
         return abs(a.ring - b.ring), min(abs(a.index - b.index), self.ring_size - abs(a.index - b.index))
 
     def is_linked_to(self, a: Position, b: Position) -> bool:
-        if a.ring == b.ring:
-            return abs(a.index - b.index) % (self.ring_size - 2) == 1
-        elif a.index == b.index:
-            if self.extended or a.index % 2 == 1:
-                return abs(a.ring - b.ring) == 1
-        return False
-
-    def neighbors_of(self, pos: Position) -> Iterator[Position]:
-        yield Position(pos.ring, (pos.index - 1) % self.ring_size)
-        yield Position(pos.ring, (pos.index + 1) % self.ring_size)
-        if self.extended or pos.index % 2 == 1:
-            if pos.ring > 0:
-                yield Position(pos.ring - 1, pos.index)
-            if pos.ring < 2:
-                yield Position(pos.ring + 1, pos.index)
+        return bool(self.kernel(_is_linked)(self._adj, self.bit_of(a), self.bit_of(b)))
+
+    def neighbors_of(self, pos: Position) -> Tuple[Position, ...]:
+        return self._neighbors[self.bit_of(pos)]
+
+    def neighbors_ids_of(self, id: int) -> Tuple[int, ...]:
+        return self._neighbors_ids[id]
 
     def get_third_in_line(self, first: Position, second: Position) -> Position:
-        if first.ring == second.ring and first.index != second.index:
-            a = min(first.index, second.index)
-            b = max(first.index, second.index)
-            if b - a > 2:  # Special condition at ring end/start
-                a, b = (b, a + self.ring_size)
-
-            if b - a == 1:
-                if a % 2 == 0:
-                    return Position(first.ring, (a + 2) % self.ring_size)
-                else:
-                    return Position(first.ring, (a - 1) % self.ring_size)
-            elif b - a == 2:
-                if a % 2 == 0:
-                    return Position(first.ring, (a + 1) % self.ring_size)
-                else:
-                    raise ValueError("Not in a valid line (two odd points cannot be on a line)")
-            else:
-                raise ValueError("Not in a valid line (distance more than 2)")
-
-        if first.ring != second.ring and first.index == second.index:
-            if self.extended or first.index % 2 == 1:
-                assert first.ring != second.ring
-                a = min(first.ring, second.ring)
-                b = max(first.ring, second.ring)
-                if a == 0:
-                    if b == 1:
-                        return Position(2, first.index)
-                    else:
-                        return Position(1, first.index)
-                else:
-                    return Position(0, first.index)
-
-        raise ValueError("Not in a valid line")
+        positions = self._positions
+        third = self.kernel(_third_in_line)(self._line, len(positions), self.bit_of(first), self.bit_of(second))
+        if third < 0:
+            raise ValueError("Not in a valid line")
+        return positions[third]
 
     def iter_fields(self) -> Iterator[Position]:
-        for ring in range(0, 3):
-            for index in range(0, self.ring_size):
-                yield Position(ring, index)
+        return iter(self._positions)
 
     def iter_lines(self) -> Iterator[Tuple[Position, Position, Position]]:
+        positions = self._positions
+        return iter([(positions[a], positions[b], positions[c]) for a, b, c in self._lines])
+
+    def iter_lines_of(self, pos: Position) -> Iterator[Tuple[Position, Position]]:
+        positions = self._positions
+        return iter([(positions[a], positions[b]) for a, b in self._lines_of[self.bit_of(pos)]])
+
+    def _compute_neighbors_of(self, pos: Position) -> Iterator[Position]:
+        yield self.P(pos.ring, (pos.index - 1) % self.ring_size)
+        yield self.P(pos.ring, (pos.index + 1) % self.ring_size)
+        if self.extended or pos.index % 2 == 1:
+            if pos.ring > 0:
+                yield self.P(pos.ring - 1, pos.index)
+            if pos.ring < 2:
+                yield self.P(pos.ring + 1, pos.index)
+
+    def _compute_lines(self) -> Iterator[Tuple[Position, Position, Position]]:
         for ring in range(0, 3):
             for side in range(0, self.sides):
                 i = side * 2
                 # Ring-parallel
-                yield Position(ring, i), Position(ring, i + 1), Position(ring, (i + 2) % self.ring_size)
+                yield self.P(ring, i), self.P(ring, i + 1), self.P(ring, (i + 2) % self.ring_size)
         for index in range(0, self.ring_size):
             if self.extended or index % 2 == 1:
-                yield Position(0, index), Position(1, index), Position(2, index)
+                yield self.P(0, index), self.P(1, index), self.P(2, index)
 
-    def iter_lines_of(self, pos: Position) -> Iterator[Tuple[Position, Position]]:
+    def _compute_lines_of(self, pos: Position) -> Iterator[Tuple[Position, Position]]:
         if self.extended or pos.index % 2 == 1:
             # Between rings
-            yield Position((pos.ring + 1) % 3, pos.index), Position((pos.ring + 2) % 3, pos.index)
+            yield self.P((pos.ring + 1) % 3, pos.index), self.P((pos.ring + 2) % 3, pos.index)
         if pos.index % 2 == 1:
             # From an odd position, parallel to a ring
-            yield Position(pos.ring, pos.index - 1), Position(pos.ring, (pos.index + 1) % self.ring_size),
+            yield self.P(pos.ring, pos.index - 1), self.P(pos.ring, (pos.index + 1) % self.ring_size),
         else:
             # From an even position, parallel to a ring
-            yield Position(pos.ring, (pos.index - 1) % self.ring_size), Position(pos.ring,
-                                                                                 (pos.index - 2) % self.ring_size),
-            yield Position(pos.ring, (pos.index + 1) % self.ring_size), Position(pos.ring,
-                                                                                 (pos.index + 2) % self.ring_size),
+            yield self.P(pos.ring, (pos.index - 1) % self.ring_size), self.P(pos.ring,
+                                                                             (pos.index - 2) % self.ring_size),
+            yield self.P(pos.ring, (pos.index + 1) % self.ring_size), self.P(pos.ring,
+                                                                             (pos.index + 2) % self.ring_size),
 
     def pretty_print(self, board: 'GameBoard'):
         data = [[" "] * self.ring_size,[" "] * self.ring_size,[" "] * self.ring_size]
-        for ring in range(0, 3):
-            for index in range(0, self.ring_size):
-                piece = board.get(Position(ring, index))
-                if piece:
-                    data[ring][index] = str(piece.playerID)
+        for pos in self._positions:
+            piece = board.get(pos)
+            if piece:
+                data[pos.ring][pos.index] = str(piece.playerID)
         ring_del = "\n  " + "   ".join([" ", "|"] * self.sides) + "\n"
         return ring_del.join("- " + " - ".join(ring) for ring in data)
 
 
 class GameBoard:
+    __slots__ = ('design', 'bb', 'zhash', '_mill_mask', '_shared')
+
     def __init__(self, design: BoardDesign):
         self.design = design
-        self.fields: Dict[Position, Piece] = dict()
-        self._count: List[int] = [0] * 2
+        self.bb: List[int] = [0, 0]  # One bitboard per player
+        self.zhash: int = 0  # Zobrist hash of the pieces on the board
+        self._mill_mask: List[int] = [0, 0]  # Pieces inside a mill, per player
+        self._shared = False  # Lists shared with a clone, copied on the next change
 
     def clone(self) -> 'GameBoard':
-        board = GameBoard(design=self.design)
-        board.fields = dict(self.fields)
-        board._count = list(self._count)
+        board = GameBoard.__new__(GameBoard)
+        board.design = self.design
+        board.bb = self.bb
+        board.zhash = self.zhash
+        board._mill_mask = self._mill_mask
+        board._shared = self._shared = True
         return board
 
+    def _unshare(self):
+        self.bb = list(self.bb)
+        self._mill_mask = list(self._mill_mask)
+        self._shared = False
+
+    def _update_mills(self, playerID: PlayerID, bit: int):
+        # Only the mills around the changed field need to be checked again
+        bb = self.bb[playerID]
+        mills = self._mill_mask[playerID] & ~self.design.mill_area_masks[bit]
+        for mask in self.design.mill_area_lines[bit]:
+            if bb & mask == mask:
+                mills |= mask
+        self._mill_mask[playerID] = mills
+
     def count(self, playerID: PlayerID) -> int:
-        # return sum(1 for p in self.fields.values() if p.playerID == playerID)
-        return self._count[playerID]
+        return self.bb[playerID].bit_count()
 
     def count_total(self) -> Tuple[int, int]:
-        return (self._count[0], self._count[1])
+        return self.bb[0].bit_count(), self.bb[1].bit_count()
+
+    def occupied(self) -> int:
+        return self.bb[0] | self.bb[1]
+
+    def owner_of_bit(self, bit: int) -> Optional[PlayerID]:
+        if (self.bb[0] >> bit) & 1:
+            return 0
+        if (self.bb[1] >> bit) & 1:
+            return 1
+        return None
 
     def is_empty(self, pos: Position):
-        return pos not in self.fields
+        return not (self.occupied() >> self.design.bit_of(pos)) & 1
 
     def iter_empty(self) -> Iterator[Position]:
-        yield from (pos for pos in self.design.iter_fields() if self.is_empty(pos))
+        pos_of = self.design.pos_of
+        yield from (pos_of(bit) for bit in iter_bits(self.design.full_mask & ~self.occupied()))
+
+    def _iter_pieces_of_mask(self, playerID: PlayerID, bb: int) -> Iterator[Tuple[Position, Piece]]:
+        pos_of = self.design.pos_of
+        piece = PIECES[playerID]
+        yield from ((pos_of(bit), piece) for bit in iter_bits(bb))
 
     def iter_pieces(self, playerID: Optional[PlayerID] = None) -> Iterator[Tuple[Position, Piece]]:
         if playerID is None:
-            yield from (e for pos, e in self.fields.items())
+            yield from self._iter_pieces_of_mask(0, self.bb[0])
+            yield from self._iter_pieces_of_mask(1, self.bb[1])
         else:
-            yield from ((pos, e) for pos, e in self.fields.items() if e.playerID == playerID)
+            yield from self._iter_pieces_of_mask(playerID, self.bb[playerID])
+
+    def mills_mask(self, playerID: PlayerID) -> int:
+        return self._mill_mask[playerID]
 
     def iter_pieces_inside_mill(self, playerID: PlayerID) -> Iterator[Tuple[Position, Piece]]:
-        all_mills_pos = set(pos for mill in self.iter_mills(playerID) for pos in mill)
-        for pos, piece in self.fields.items():
-            if piece.playerID == playerID and pos in all_mills_pos:
-                yield pos, piece
+        yield from self._iter_pieces_of_mask(playerID, self._mill_mask[playerID])
 
     def iter_pieces_outside_mill(self, playerID: PlayerID) -> Iterator[Tuple[Position, Piece]]:
-        all_mills_pos = set(pos for mill in self.iter_mills(playerID) for pos in mill)
-        for pos, piece in self.fields.items():
-            if piece.playerID == playerID and pos not in all_mills_pos:
-                yield pos, piece
+        yield from self._iter_pieces_of_mask(playerID, self.bb[playerID] & ~self._mill_mask[playerID])
 
     def is_inside_a_mill(self, playerID: PlayerID, pos: Position):
-        piece = self.fields.get(pos, None)
-        if piece and piece.playerID == playerID:
-            for line in self.design.iter_lines_of(pos):
-                pieces = (self.fields.get(p, None) for p in line)
-                if all((p.playerID == playerID if p else False) for p in pieces):
-                    return True
-        return False
-
-    def iter_ready_mills(self, playerID: PlayerID, pos: Position) -> Iterator[Tuple[Position, Position]]:
-        if pos in self.fields:  # Not empty, so no mill is ready for pos
+        return bool((self._mill_mask[playerID] >> self.design.bit_of(pos)) & 1)
+
+    def iter_ready_mills(self, playerID: PlayerID, pos: Position) -> Iterator[int]:
+        bit = self.design.bit_of(pos)
+        if (self.occupied() >> bit) & 1:  # Not empty, so no mill is ready for pos
             return
-        for second_pos, third_pos in self.design.iter_lines_of(pos):
-            second = self.fields.get(second_pos, None)
-            third = self.fields.get(third_pos, None)
-            if second and third and second.playerID == playerID and third.playerID == playerID:
-                yield second_pos, third_pos
-
-    def iter_mills(self, playerID: PlayerID) -> Iterator[Tuple[Position, Position, Position]]:
-        for line in self.design.iter_lines():
-            pieces = (self.fields.get(p, None) for p in line)
-            if all((p.playerID == playerID if p else False) for p in pieces):
-                yield line
+        bb = self.bb[playerID]
+        for mask in self.design.lines_of_masks[bit]:
+            if bb & mask == mask:
+                yield mask
+
+    def iter_mills(self, playerID: PlayerID) -> Iterator[int]:
+        bb = self.bb[playerID]
+        for mask in self.design.mill_masks:
+            if bb & mask == mask:
+                yield mask
 
     def place(self, pos: Position, piece: Piece):
-        assert pos not in self.fields
-        self.fields[pos] = piece
-        self._count[piece.playerID] += 1
+        self.place_bit(self.design.bit_of(pos), piece.playerID)
+
+    def place_bit(self, bit: int, playerID: PlayerID):
+        assert not (self.occupied() >> bit) & 1
+        if self._shared:
+            self._unshare()
+        self.bb[playerID] |= 1 << bit
+        self.zhash ^= self.design.zobrist[bit][playerID]
+        self._update_mills(playerID, bit)
 
     def get(self, pos: Position) -> Optional[Piece]:
-        return self.fields.get(pos, None)
+        playerID = self.owner_of_bit(self.design.bit_of(pos))
+        return None if playerID is None else PIECES[playerID]
 
     def move(self, start: Position, end: Position):
         assert self.design.is_linked_to(start, end)
         self.jump(start, end)
 
+    def move_bit(self, start_bit: int, end_bit: int):
+        assert (self.design.neighbor_masks[start_bit] >> end_bit) & 1
+        self.jump_bit(start_bit, end_bit)
+
     def jump(self, start: Position, end: Position):
-        assert end not in self.fields
-        piece = self.fields.pop(start)
-        assert piece
-        self.fields[end] = piece
+        self.jump_bit(self.design.bit_of(start), self.design.bit_of(end))
+
+    def jump_bit(self, start_bit: int, end_bit: int):
+        assert not (self.occupied() >> end_bit) & 1
+        playerID = self.owner_of_bit(start_bit)
+        assert playerID is not None
+        if self._shared:
+            self._unshare()
+        self.bb[playerID] ^= (1 << start_bit) | (1 << end_bit)
+        self.zhash ^= self.design.zobrist[start_bit][playerID] ^ self.design.zobrist[end_bit][playerID]
+        self._update_mills(playerID, start_bit)
+        self._update_mills(playerID, end_bit)
 
     def remove(self, pos: Position) -> Optional[Piece]:
-        piece = self.fields.pop(pos, None)
-        if piece:
-            self._count[piece.playerID] -= 1
-        return piece
+        playerID = self.remove_bit(self.design.bit_of(pos))
+        return None if playerID is None else PIECES[playerID]
+
+    def remove_bit(self, bit: int) -> Optional[PlayerID]:
+        playerID = self.owner_of_bit(bit)
+        if playerID is not None:
+            if self._shared:
+                self._unshare()
+            self.bb[playerID] &= ~(1 << bit)
+            self.zhash ^= self.design.zobrist[bit][playerID]
+            self._update_mills(playerID, bit)
+        return playerID
 
     def iter_available_moves(self, pos: Position) -> Iterator[Position]:
-        for npos in self.design.neighbors_of(pos):
-            if npos not in self.fields:
-                yield npos
-
-
-class ActionType(Enum):
-    PLACE = 1
-    MOVE = 2
-    JUMP = 3
-
-
-class Action(ABC):
-    def __init__(self, actiontype: ActionType, playerID: PlayerID, attacks: Optional[List[Position]] = None):
-        self.actiontype = actiontype
-        self.playerID = playerID
-        self.attacks = attacks
-
-    @abstractmethod
-    def __repr__(self):
-        ...
-
-    def __str__(self):
-        return self.__repr__()
-
-    def __eq__(self, other):
-        if isinstance(other, Action):
-            return self.actiontype == other.actiontype and self.playerID == other.playerID and self.attacks == other.attacks
-        return False
-
-    def __hash__(self):
-        attacks_hash = 0
-        if self.attacks:
-            attacks_hash = hash((*self.attacks,))
-        return hash((self.actiontype, self.playerID, attacks_hash))
-
-
-class PlaceAction(Action):
-    def __init__(self, playerID: PlayerID, pos: Position, **kwargs):
-        super(PlaceAction, self).__init__(ActionType.PLACE, playerID, **kwargs)
-        self.pos = pos
-
-    def __repr__(self):
-        if self.attacks:
-            return "Place(%s, %s, attacks=%s)" % (self.playerID, self.pos, self.attacks)
-        return "Place(%s, %s)" % (self.playerID, self.pos)
-
-    def __eq__(self, other):
-        if isinstance(other, PlaceAction):
-            return super(PlaceAction, self).__eq__(other) and self.pos == other.pos
-        return False
-
-    def __hash__(self):
-        return hash((super(PlaceAction, self).__hash__(), self.pos))
-
-
-class MoveAction(Action):
-    def __init__(self, playerID: PlayerID, start: Position, end: Position, **kwargs):
-        super(MoveAction, self).__init__(ActionType.MOVE, playerID, **kwargs)
-        self.start = start
-        self.end = end
-
-    def __repr__(self):
-        if self.attacks:
-            return "Move(%s, from=%s, to=%s, attacks=%s)" % (self.playerID, self.start, self.end, self.attacks)
-        return "Move(%s, from=%s, to=%s)" % (self.playerID, self.start, self.end)
-
-    def __eq__(self, other):
-        if isinstance(other, MoveAction):
-            return super(MoveAction, self).__eq__(other) and self.start == other.start and self.end == other.end
-        return False
-
-    def __hash__(self):
-        return hash((super(MoveAction, self).__hash__(), self.start, self.end))
-
-
-class JumpAction(Action):
-    def __init__(self, playerID: PlayerID, start: Position, end: Position, **kwargs):
-        super(JumpAction, self).__init__(ActionType.JUMP, playerID, **kwargs)
-        self.start = start
-        self.end = end
-
-    def __repr__(self):
-        if self.attacks:
-            return "Jump(%s, from=%s, to=%s, attacks=%s)" % (self.playerID, self.start, self.end, self.attacks)
-        return "Jump(%s, from=%s, to=%s)" % (self.playerID, self.start, self.end)
-
-    def __eq__(self, other):
-        if isinstance(other, JumpAction):
-            return super(JumpAction, self).__eq__(other) and self.start == other.start and self.end == other.end
-        return False
-
-    def __hash__(self):
-        return hash((super(JumpAction, self).__hash__(), self.start, self.end))
+        pos_of = self.design.pos_of
+        free = self.design.neighbor_masks[self.design.bit_of(pos)] & ~self.occupied()
+        yield from (pos_of(bit) for bit in iter_bits(free))
+
+
+# An action is packed into an int. From the lowest bit on: the action kind (4 bits), the player (1 bit),
+# the start field (8 bits), the end field (8 bits) and the mask of attacked fields in all remaining bits.
+Action = int
+
+ACTION_PLACE = 1
+ACTION_MOVE = 2
+ACTION_JUMP = 3
+
+ACTION_KIND_MASK = 0xF
+ACTION_FIELD_MASK = 0xFF
+ACTION_PLAYER_SHIFT = 4
+ACTION_START_SHIFT = 5
+ACTION_END_SHIFT = 13
+ACTION_ATTACKS_SHIFT = 21
+
+
+def pack_action(kind: int, playerID: PlayerID, start: int, end: int, attacks: int = 0) -> Action:
+    return (kind | (playerID << ACTION_PLAYER_SHIFT) | (start << ACTION_START_SHIFT) | (end << ACTION_END_SHIFT)
+            | (attacks << ACTION_ATTACKS_SHIFT))
+
+
+def unpack_action(action: Action) -> Tuple[int, PlayerID, int, int, int]:
+    return (action & ACTION_KIND_MASK,
+            (action >> ACTION_PLAYER_SHIFT) & 1,
+            (action >> ACTION_START_SHIFT) & ACTION_FIELD_MASK,
+            (action >> ACTION_END_SHIFT) & ACTION_FIELD_MASK,
+            action >> ACTION_ATTACKS_SHIFT)
+
+
+def action_attacks(action: Action) -> int:
+    return action >> ACTION_ATTACKS_SHIFT
+
+
+def repr_action(action: Action, design: BoardDesign) -> str:
+    kind, playerID, start, end, attacks = unpack_action(action)
+    if kind == ACTION_PLACE:
+        text = "Place(%s, %s" % (playerID, design.pos_of(end))
+    elif kind == ACTION_MOVE:
+        text = "Move(%s, from=%s, to=%s" % (playerID, design.pos_of(start), design.pos_of(end))
+    elif kind == ACTION_JUMP:
+        text = "Jump(%s, from=%s, to=%s" % (playerID, design.pos_of(start), design.pos_of(end))
+    else:
+        raise ValueError("Invalid action type")
+    if attacks:
+        return text + ", attacks=%s)" % [design.pos_of(bit) for bit in iter_bits(attacks)]
+    return text + ")"
+
+
+@njit
+def popcount(bb):
+    count = 0
+    while bb:
+        bb &= bb - 1
+        count += 1
+    return count
+
+
+@njit
+def binomial(n, r):
+    if r < 0 or r > n:
+        return 0
+    result = 1
+    for i in range(r):
+        result = result * (n - i) // (i + 1)
+    return result
+
+
+@njit
+def deposit_bits(bits, mask):
+    # Scatters the lowest bits onto the set bits of the mask, from the lowest on
+    result = 0
+    while bits:
+        low = mask & -mask
+        if bits & 1:
+            result |= low
+        mask ^= low
+        bits >>= 1
+    return result
+
+
+@njit
+def next_combination(sub):
+    # Gosper's hack, the next larger number with the same count of set bits
+    c = sub & -sub
+    r = sub + c
+    return (((r ^ sub) >> 2) // c) | r
+
+
+@njit
+def nth_combination(mask, m, k):
+    # The k-th subset of m set bits of the mask, in the ascending order of next_combination
+    sub = 0
+    while m > 0:
+        c = m - 1
+        while binomial(c + 1, m) <= k:
+            c += 1
+        k -= binomial(c, m)
+        sub |= 1 << c
+        m -= 1
+    return deposit_bits(sub, mask)
+
+
+@njit
+def action_kind(pieces, placed, max_placed):
+    if placed < max_placed:
+        return ACTION_PLACE
+    count = popcount(pieces)
+    if count > 3:
+        return ACTION_MOVE
+    if count == 3:
+        return ACTION_JUMP
+    return 0  # Lost, no actions left
+
+
+@njit
+def attackable_pieces(other, other_mills):
+    # Pieces outside mills are attacked first
+    outside = other & ~other_mills
+    return outside if outside else other
+
+
+@njit
+def collect_moves(kind, pieces, empty, neighbor_masks, lines_of):
+    """
+    Collects the start and end field bits of all moves of an action kind, in the order of the actions.
+    Also counts the mills each move closes.
+    """
+    n_fields = len(neighbor_masks)
+    starts = []
+    ends = []
+    if kind == ACTION_PLACE:
+        for end in range(n_fields):
+            if (empty >> end) & 1:
+                starts.append(0)
+                ends.append(end)
+    elif kind != 0:
+        for start in range(n_fields):
+            if (pieces >> start) & 1:
+                free = neighbor_masks[start] & empty if kind == ACTION_MOVE else empty
+                for end in range(n_fields):
+                    if (free >> end) & 1:
+                        starts.append(start)
+                        ends.append(end)
+    mills = []
+    for end in ends:
+        count = 0
+        for mask in lines_of[end]:
+            if pieces & mask == mask:
+                count += 1
+        mills.append(count)
+    return starts, ends, mills
+
+
+@njit
+def available_actions(playerID, kind, pieces, other, other_mills, full_mask, neighbor_masks, lines_of):
+    # Compiled by numba the packed actions are int64, which fits boards up to 42 fields (sides=7).
+    # Larger designs run the plain Python kernel, see BoardDesign.kernel.
+    starts, ends, mills = collect_moves(kind, pieces, full_mask & ~(pieces | other), neighbor_masks, lines_of)
+    attackable = attackable_pieces(other, other_mills)
+    n_attackable = popcount(attackable)
+
+    actions = []
+    for i in range(len(ends)):
+        action = (kind | (playerID << ACTION_PLAYER_SHIFT) | (starts[i] << ACTION_START_SHIFT)
+                  | (ends[i] << ACTION_END_SHIFT))
+        m = mills[i]
+        if m:
+            # One attack per closed mill, for each subset of m attackable pieces
+            sub = (1 << m) - 1
+            while sub < 1 << n_attackable:
+                actions.append(action | (deposit_bits(sub, attackable) << ACTION_ATTACKS_SHIFT))
+                sub = next_combination(sub)
+        else:
+            actions.append(action)
+    return actions
+
+
+@njit
+def rollout(bb0, bb1, player, placed0, placed1, max_placed, steps, max_depth, rand,
+            full_mask, mill_masks, neighbor_masks, lines_of):
+    """
+    Plays random actions like SimpleSimulationPolicy.take_action until the game ends or max_depth is reached.
+    The action of each step is drawn from rand[step].
+    Returns the steps, the winner (-1 if max depth reached) and the pieces left of both players.
+    """
+    while steps < max_depth:
+        pieces = bb0 if player == 0 else bb1
+        other = bb1 if player == 0 else bb0
+        placed = placed0 if player == 0 else placed1
+
+        other_mills = 0
+        for mask in mill_masks:
+            if other & mask == mask:
+                other_mills |= mask
+        attackable = attackable_pieces(other, other_mills)
+        n_attackable = popcount(attackable)
+
+        kind = action_kind(pieces, placed, max_placed)
+        starts, ends, mills = collect_moves(kind, pieces, full_mask & ~(bb0 | bb1), neighbor_masks, lines_of)
+
+        n_attacks = 0
+        n_plain = 0
+        for m in mills:
+            if m:
+                n_attacks += binomial(n_attackable, m)
+            else:
+                n_plain += 1
+        if n_attacks + n_plain == 0:
+            return steps, 1 - player, popcount(bb0), popcount(bb1)
+
+        # Prefer actions with an attack
+        chosen = 0
+        attacks = 0
+        if n_attacks:
+            k = rand[steps] % n_attacks
+            for i in range(len(mills)):
+                m = mills[i]
+                if m:
+                    combinations = binomial(n_attackable, m)
+                    if k < combinations:
+                        chosen = i
+                        attacks = nth_combination(attackable, m, k)
+                        break
+                    k -= combinations
+        else:
+            k = rand[steps] % n_plain
+            for i in range(len(mills)):
+                if not mills[i]:
+                    if k == 0:
+                        chosen = i
+                        break
+                    k -= 1
+
+        if kind != ACTION_PLACE:
+            pieces &= ~(1 << starts[chosen])
+        pieces |= 1 << ends[chosen]
+        other &= ~attacks
+        if player == 0:
+            bb0, bb1 = pieces, other
+            if kind == ACTION_PLACE:
+                placed0 += 1
+        else:
+            bb0, bb1 = other, pieces
+            if kind == ACTION_PLACE:
+                placed1 += 1
+        player = 1 - player
+        steps += 1
+
+    return steps, -1, popcount(bb0), popcount(bb1)
+
+
+@njit
+def rollout_batch(bb0, bb1, player, placed0, placed1, max_placed, steps, max_depth, rand,
+                  full_mask, mill_masks, neighbor_masks, lines_of):
+    results = []
+    for row in rand:
+        results.append(rollout(bb0, bb1, player, placed0, placed1, max_placed, steps, max_depth, row,
+                               full_mask, mill_masks, neighbor_masks, lines_of))
+    return results
+
+
+# Source of the execute functions per action kind. The shifts, masks and the max placed items are filled in as
+# literals, so the executors neither unpack the action generically nor look up any constants.
+_EXECUTE_SOURCE = """
+def execute_place(state, action):
+    assert not state.frozen
+    playerID = (action >> {player_shift}) & 1
+    assert playerID == state.player_turn.playerID
+    assert state.placed_items[playerID] < {max_placed_items}
+    board = state.board
+    board.place_bit((action >> {end_shift}) & {field_mask}, playerID)
+    state.placed_items[playerID] += 1
+{finish}
+
+def execute_move(state, action):
+    assert not state.frozen
+    playerID = (action >> {player_shift}) & 1
+    assert playerID == state.player_turn.playerID
+    board = state.board
+    start = (action >> {start_shift}) & {field_mask}
+    assert board.owner_of_bit(start) == playerID
+    board.move_bit(start, (action >> {end_shift}) & {field_mask})
+{finish}
+
+def execute_jump(state, action):
+    assert not state.frozen
+    playerID = (action >> {player_shift}) & 1
+    assert playerID == state.player_turn.playerID
+    board = state.board
+    start = (action >> {start_shift}) & {field_mask}
+    assert board.owner_of_bit(start) == playerID
+    board.jump_bit(start, (action >> {end_shift}) & {field_mask})
+{finish}
+"""
+
+_EXECUTE_FINISH = """
+    attacks = action >> {attacks_shift}
+    while attacks:
+        low = attacks & -attacks
+        attacked = board.remove_bit(low.bit_length() - 1)
+        assert attacked is not None and attacked != playerID
+        attacks ^= low
+    state.player_turn = state.players[playerID ^ 1]
+    state.ply += 1
+    state._undo.append(action)
+"""
+
+_executors: Dict[int, Tuple] = dict()
+
+
+def _execute_invalid(state: 'GameState', action: Action):
+    raise ValueError("Invalid action type")
+
+
+def executors_of(max_placed_items: int) -> Tuple:
+    """Returns the execute functions of a game, indexed by the action kind."""
+    if max_placed_items not in _executors:
+        constants = dict(max_placed_items=max_placed_items, player_shift=ACTION_PLAYER_SHIFT,
+                         start_shift=ACTION_START_SHIFT, end_shift=ACTION_END_SHIFT,
+                         attacks_shift=ACTION_ATTACKS_SHIFT, field_mask=ACTION_FIELD_MASK)
+        source = _EXECUTE_SOURCE.format(finish=_EXECUTE_FINISH.format(**constants).rstrip(), **constants)
+        namespace = dict()
+        exec(compile(source, "<execute max_placed_items=%d>" % max_placed_items, "exec"), namespace)
+        dispatch = [_execute_invalid] * (ACTION_KIND_MASK + 1)
+        dispatch[ACTION_PLACE] = namespace["execute_place"]
+        dispatch[ACTION_MOVE] = namespace["execute_move"]
+        dispatch[ACTION_JUMP] = namespace["execute_jump"]
+        _executors[max_placed_items] = tuple(dispatch)
+    return _executors[max_placed_items]
 
 
 class GameState:
+    __slots__ = ('players', 'placed_items', 'player_turn', 'board', 'max_placed_items', 'ply', 'frozen', '_actions',
+                 '_undo', '_dispatch')
+
     def __init__(self, sides: int = 4):
         self.players = (Player(0), Player(1))
-        self.placed_items = defaultdict(lambda: 0)
+        self.placed_items: List[int] = [0, 0]
         self.player_turn = self.players[0]
         self.board = GameBoard(DefaultBoardDesign(sides=sides))
+        if self.board.design.full_mask.bit_length() > ACTION_FIELD_MASK + 1:
+            raise ValueError("Actions can address at most %d fields" % (ACTION_FIELD_MASK + 1))
         self.max_placed_items = int(sides / 4 * 9)
+        self.ply = 0
         self.frozen = False
+        self._actions: Optional[Tuple[Action, ...]] = None
+        self._undo: List[Action] = []  # Executed actions that can be undone
+        self._dispatch = executors_of(self.max_placed_items)
 
     def freeze(self):
-        self.frozen = True
+        if not self.frozen:
+            self.frozen = True
+            # A frozen state never changes, so its actions are computed only once
+            self._actions = tuple(self._iter_available_actions(self.player_turn))
 
     def clone(self) -> 'GameState':
-        game = GameState()
+        game = GameState.__new__(GameState)  # Skip __init__, it would rebuild the board design
         game.players = self.players
-        game.placed_items = defaultdict(lambda: 0, self.placed_items)
+        game.placed_items = self.placed_items[:]
         game.player_turn = self.player_turn
         game.board = self.board.clone()
         game.max_placed_items = self.max_placed_items
+        game.ply = self.ply
+        game.frozen = False
+        game._actions = None
+        game._undo = []
+        game._dispatch = self._dispatch
         return game
 
+    def state_key(self) -> int:
+        # The ply determines both the player turn and the placed items. It also keeps states that are reached
+        # again later in the game apart, so transpositions never form a cycle.
+        return (self.ply << 64) | self.board.zhash
+
     def other(self, player: Union[Player, PlayerID]) -> Player:
         if isinstance(player, Player):
             return self.players[(player.playerID + 1) % 2]
@@ -394,81 +874,54 @@ class GameState:
         else:
             raise ValueError("Invalid player format!")
 
-    def calc_available_attacks(self, player: Player) -> List[Tuple[Position, Piece]]:
+    def calc_available_attacks(self, player: Player) -> int:
         otherID = self.other(player).playerID
-        outside = list(self.board.iter_pieces_outside_mill(otherID))
-        if outside:
-            return outside
-        inside = list(self.board.iter_pieces_inside_mill(otherID))
-        if inside:
-            return inside
-        return []
+        return self.board.design.kernel(attackable_pieces)(self.board.bb[otherID], self.board.mills_mask(otherID))
 
     def calc_available_actions(self, player: Player = None) -> Iterator[Action]:
         player = self.player_turn if player is None else player
-        playerID = player.playerID
-        player_board_count = self.board.count(playerID)
+        if self._actions is not None and player is self.player_turn:
+            return iter(self._actions)
+        return self._iter_available_actions(player)
 
-        available_attacks = self.calc_available_attacks(player)
+    def _iter_available_actions(self, player: Player) -> Iterator[Action]:
+        board = self.board
+        playerID = player.playerID
+        otherID = self.other(player).playerID
+        pieces = board.bb[playerID]
+        design = board.design
+        full_mask, mill_masks, neighbor_masks, lines_of = design.kernel_tables
+        kind = design.kernel(action_kind)(pieces, self.placed_items[playerID], self.max_placed_items)
+        return iter(design.kernel(available_actions)(playerID, kind, pieces, board.bb[otherID],
+                                                     board.mills_mask(otherID), full_mask, neighbor_masks, lines_of))
 
-        def enhance_with_attacks(pos: Position, action_cls: Type[Action], *args, **kwargs):
-            mills = list(self.board.iter_ready_mills(player.playerID, pos))
-            if mills:
-                for comb in itertools.combinations(available_attacks, len(mills)):
-                    kwargs['attacks'] = list(p for p, e in comb)
-                    yield action_cls(*args, **kwargs)
-            else:
-                yield action_cls(*args, **kwargs)
-
-        # Check if in placing game phase
-        if self.placed_items[playerID] < self.max_placed_items:
-            for empty_pos in self.board.iter_empty():
-                yield from enhance_with_attacks(empty_pos, PlaceAction, playerID, empty_pos)
-
-        # Normal move phase
-        elif player_board_count > 3:
-            for pos, piece in self.board.iter_pieces(playerID):
-                for end_pos in self.board.iter_available_moves(pos):
-                    yield from enhance_with_attacks(end_pos, MoveAction, playerID, pos, end_pos)
-
-        # Check if in jumping game phase
-        elif player_board_count == 3:
-            for pos, piece in self.board.iter_pieces(playerID):
-                for empty_pos in self.board.iter_empty():
-                    yield from enhance_with_attacks(empty_pos, JumpAction, playerID, pos, empty_pos)
-
-    def execute(self, action: Action) -> 'GameState':
-        assert not self.frozen
+    def execute(self, action: Action):
+        self._dispatch[action & ACTION_KIND_MASK](self, action)
 
-        playerID = action.playerID
-        assert playerID == self.player_turn.playerID
+    def can_undo(self) -> bool:
+        return bool(self._undo)
 
-        if isinstance(action, PlaceAction):
-            assert self.placed_items[playerID] < self.max_placed_items
-            self.board.place(action.pos, Piece(playerID))
-            self.placed_items[playerID] += 1
+    def undo(self) -> Action:
+        """Reverts the last executed action (since the last clone) and returns it."""
+        assert not self.frozen
 
-        elif isinstance(action, MoveAction):
-            piece = self.board.get(action.start)
-            assert piece
-            assert piece.playerID == playerID
-            self.board.move(action.start, action.end)
+        action = self._undo.pop()
+        kind, playerID, start, end, attacks = unpack_action(action)
 
-        elif isinstance(action, JumpAction):
-            piece = self.board.get(action.start)
-            assert piece
-            assert piece.playerID == playerID
-            self.board.jump(action.start, action.end)
+        # The attacked pieces are all pieces of the other player
+        otherID = self.other(playerID).playerID
+        for attack_bit in iter_bits(attacks):
+            self.board.place_bit(attack_bit, otherID)
 
+        if kind == ACTION_PLACE:
+            self.board.remove_bit(end)
+            self.placed_items[playerID] -= 1
         else:
-            raise ValueError("Invalid action type")
-
-        if action.attacks:
-            for attack_pos in action.attacks:
-                attacked = self.board.remove(attack_pos)
-                assert attacked.playerID != playerID
+            self.board.jump_bit(end, start)
 
-        self.player_turn = self.other(self.player_turn)
+        self.player_turn = self.players[playerID]
+        self.ply -= 1
+        return action
 
     def pretty_print(self):
         return self.board.design.pretty_print(self.board)
@@ -482,7 +935,7 @@ def main():
             print("Game end! Winner: %s" % g.other(g.player_turn))
             break
         action = random.choice(actions)
-        print(action)
+        print(repr_action(action, g.board.design))
         g = g.clone()
         g.execute(action)
         print(g.board.design.pretty_print(g.board))
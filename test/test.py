@@ -1,14 +1,29 @@
+import functools
+import itertools
+import random
 import unittest
 from typing import Callable
 
-from mühle import DefaultBoardDesign, Position
+from mcts._rollout_nb import random_buffer, random_generator, rollout_state
+from mcts.base import MCTS
+from mcts.simple import SimpleSimulationPolicy, SimpleSelectionPolicy, SimpleExpansionPolicy, \
+    SimpleBackpropagationPolicy, init_mcts
+from mühle import DefaultBoardDesign, Position, GameBoard, Piece, GameState, ACTION_PLACE, ACTION_MOVE, ACTION_JUMP, \
+    PIECES, pack_action, unpack_action, repr_action, action_attacks, binomial, deposit_bits, next_combination, \
+    nth_combination
+
+
+@functools.lru_cache(maxsize=None)
+def _board(sides: int, extended: bool) -> DefaultBoardDesign:
+    # Designs are never changed, so the tests share one per configuration
+    return DefaultBoardDesign(sides=sides, extended=extended)
 
 
 class TestDefaultBoardDesign(unittest.TestCase):
 
     def test_neighbor_positions(self):
         for sides in range(3, 5):
-            b = DefaultBoardDesign(sides=sides)
+            b = _board(sides, False)
             self.assertEqual(
                 set(b.neighbors_of(Position(1, 1))),
                 {Position(0, 1), Position(2, 1), Position(1, 0), Position(1, 2)}
@@ -17,11 +32,21 @@ class TestDefaultBoardDesign(unittest.TestCase):
                 set(b.neighbors_of(Position(1, 0))),
                 {Position(1, b.ring_size - 1), Position(1, 1)}
             )
+            self.assertEqual(
+                set(b.neighbors_ids_of(b.id(Position(1, 1)))),
+                {b.id(Position(0, 1)), b.id(Position(2, 1)), b.id(Position(1, 0)), b.id(Position(1, 2))}
+            )
+            self.assertEqual(b.pos(b.id(Position(1, 1))), Position(1, 1))
+
+    def test_positions_interned(self):
+        self.assertIs(Position(1, 2), Position(1, 2))
+        self.assertIs(_board(4, False).pos_of(10), Position(1, 2))
+        self.assertNotEqual(Position(1, 2), Position(2, 1))
 
     def test_get_third_in_line(self):
         for extended in (False, True):
             for sides in range(3, 5):
-                b = DefaultBoardDesign(sides=sides, extended=extended)
+                b = _board(sides, extended)
                 # Check line getter on rings
                 for ring in range(0, 2):
                     for n in range(0, b.sides):
@@ -54,35 +79,258 @@ class TestDefaultBoardDesign(unittest.TestCase):
                             Position(0, index)
                         )
 
-    def test_is_linked_to(self):
+    # (extended or None for both, expected link, first (ring, index), second (ring, index)).
+    # Negative indices count back from the ring size.
+    _CASES = [
+        # On ring
+        (None, True, (0, 0), (0, 1)),
+        (None, True, (0, 1), (0, 2)),
+        (None, True, (0, -1), (0, 0)),
+        (None, False, (0, 0), (0, 2)),
+        (None, False, (0, 1), (0, 3)),
+        (None, False, (0, -1), (0, 1)),
+        (None, False, (0, -2), (0, 0)),
+        # Between rings
+        (None, True, (0, 1), (1, 1)),
+        (None, True, (1, 1), (2, 1)),
+        (False, False, (0, 1), (2, 1)),
+        (None, False, (0, 1), (1, 3)),
+        (True, True, (0, 0), (1, 0)),
+        (True, True, (1, 0), (2, 0)),
+        (True, False, (0, 0), (2, 0)),
+        (True, False, (0, 0), (1, 2)),
+    ]
 
+    def test_is_linked_to(self):
         for extended in (False, True):
             for sides in range(3, 5):
-                b = DefaultBoardDesign(sides=sides, extended=extended)
-
-                def flip(check, x, y):
-                    check(b.is_linked_to(x, y))
-                    check(b.is_linked_to(y, x))
-
-                # On ring
-                flip(self.assertTrue, Position(0,0), Position(0, 1))
-                flip(self.assertTrue, Position(0,1), Position(0, 2))
-                flip(self.assertTrue, Position(0,b.ring_size-1), Position(0, 0))
-
-                flip(self.assertFalse, Position(0,0), Position(0, 2))
-                flip(self.assertFalse, Position(0,1), Position(0, 3))
-                flip(self.assertFalse, Position(0,b.ring_size-1), Position(0, 1))
-                flip(self.assertFalse, Position(0,b.ring_size-2), Position(0, 0))
-
-                # Between rings
-                flip(self.assertTrue, Position(0,1), Position(1, 1))
-                flip(self.assertTrue, Position(1,1), Position(2, 1))
-                if not extended:
-                    flip(self.assertFalse, Position(0,1), Position(2, 1))
-                flip(self.assertFalse, Position(0,1), Position(1, 3))
-
-                if extended:
-                    flip(self.assertTrue, Position(0,0), Position(1, 0))
-                    flip(self.assertTrue, Position(1,0), Position(2, 0))
-                    flip(self.assertFalse, Position(0,0), Position(2, 0))
-                    flip(self.assertFalse, Position(0,0), Position(1, 2))
+                b = _board(sides, extended)
+                for case in self._CASES:
+                    only_extended, expected, (a_ring, a_index), (b_ring, b_index) = case
+                    if only_extended is not None and only_extended != extended:
+                        continue
+                    with self.subTest(sides=sides, extended=extended, case=case):
+                        a_id = a_ring * b.ring_size + a_index % b.ring_size
+                        b_id = b_ring * b.ring_size + b_index % b.ring_size
+                        self.assertEqual(bool((int(b._adj[a_id]) >> b_id) & 1), expected)
+                        self.assertEqual(bool((int(b._adj[b_id]) >> a_id) & 1), expected)
+                        self.assertEqual(b.is_linked_to(b.pos_of(a_id), b.pos_of(b_id)), expected)
+
+
+class TestGameBoard(unittest.TestCase):
+
+    def test_mills(self):
+        for sides in range(3, 5):
+            b = GameBoard(_board(sides, False))
+            b.place(Position(0, 0), Piece(0))
+            b.place(Position(0, 1), Piece(0))
+            b.place(Position(1, 1), Piece(1))
+            self.assertEqual(list(b.iter_mills(0)), [])
+            self.assertEqual(len(list(b.iter_ready_mills(0, Position(0, 2)))), 1)
+            self.assertEqual(list(b.iter_ready_mills(1, Position(0, 2))), [])
+
+            b.place(Position(0, 2), Piece(0))
+            self.assertEqual(len(list(b.iter_mills(0))), 1)
+            self.assertTrue(b.is_inside_a_mill(0, Position(0, 1)))
+            self.assertFalse(b.is_inside_a_mill(1, Position(1, 1)))
+            self.assertEqual({p for p, _ in b.iter_pieces_inside_mill(0)},
+                             {Position(0, 0), Position(0, 1), Position(0, 2)})
+            self.assertEqual({p for p, _ in b.iter_pieces_outside_mill(1)}, {Position(1, 1)})
+
+            b.jump(Position(0, 1), Position(2, 3))
+            self.assertEqual(list(b.iter_mills(0)), [])
+            self.assertEqual(b.count_total(), (3, 1))
+            self.assertEqual(b.remove(Position(1, 1)).playerID, 1)
+            self.assertEqual(b.count_total(), (3, 0))
+
+    def test_pieces_read_only(self):
+        with self.assertRaises(AttributeError):
+            PIECES[0].playerID = 1
+        self.assertEqual(PIECES[0].playerID, 0)
+
+    def test_clone_copy_on_write(self):
+        b = GameBoard(_board(4, False))
+        b.place(Position(0, 0), Piece(0))
+        c = b.clone()
+        c.place(Position(0, 1), Piece(1))
+        b.remove(Position(0, 0))
+        self.assertEqual(b.count_total(), (0, 0))
+        self.assertEqual(c.count_total(), (1, 1))
+        self.assertEqual(c.get(Position(0, 0)).playerID, 0)
+
+
+class TestGameState(unittest.TestCase):
+
+    def test_state_key_transposition(self):
+        def play(*places):
+            g = GameState(sides=4)
+            for n, (ring, index) in enumerate(places):
+                g.execute(pack_action(ACTION_PLACE, n % 2, 0, g.board.design.bit_of(Position(ring, index))))
+            return g
+
+        a = play((0, 0), (1, 1), (0, 2), (2, 5))
+        b = play((0, 2), (2, 5), (0, 0), (1, 1))
+        c = play((0, 2), (1, 1), (0, 0), (2, 5))
+        self.assertEqual(a.state_key(), b.state_key())
+        self.assertEqual(a.state_key(), c.state_key())
+        self.assertNotEqual(a.state_key(), play((0, 0), (1, 1), (0, 2)).state_key())
+        self.assertNotEqual(a.state_key(), play((1, 1), (0, 0), (0, 2), (2, 5)).state_key())
+
+    def test_pack_action(self):
+        design = _board(4, False)
+        action = pack_action(ACTION_JUMP, 1, 3, 23, (1 << 0) | (1 << 17))
+        self.assertEqual(unpack_action(action), (ACTION_JUMP, 1, 3, 23, (1 << 0) | (1 << 17)))
+        self.assertEqual(repr_action(action, design), "Jump(1, from=0:3, to=2:7, attacks=[Pos(0:0), Pos(2:1)])")
+        self.assertEqual(repr_action(pack_action(ACTION_PLACE, 0, 0, 9), design), "Place(0, 1:1)")
+        with self.assertRaises(ValueError):
+            GameState().execute(pack_action(0, 0, 0, 9))
+
+    def test_undo(self):
+        rand = random.Random(42)
+        for sides in range(3, 5):
+            g = GameState(sides=sides)
+            snapshots = []
+            for _ in range(60):
+                actions = list(g.calc_available_actions())
+                if not actions:
+                    break
+                snapshots.append((list(g.board.bb), g.board.zhash, list(g.board._mill_mask), list(g.placed_items),
+                                  g.player_turn, g.ply))
+                g.execute(rand.choice(actions))
+            while snapshots:
+                g.undo()
+                self.assertEqual((list(g.board.bb), g.board.zhash, list(g.board._mill_mask), list(g.placed_items),
+                                  g.player_turn, g.ply), snapshots.pop())
+            self.assertFalse(g.can_undo())
+
+    def test_large_boards(self):
+        # The packed actions of sides >= 8 do not fit into the int64 values of the compiled kernels.
+        # Regression: sides = 11 has 66 fields, which the former 6 bit field layout of the actions corrupted.
+        rand = random.Random(7)
+        for sides in (7, 8, 11):
+            g = GameState(sides=sides)
+            for _ in range(80):
+                actions = list(g.calc_available_actions())
+                if not actions:
+                    break
+                for action in actions:
+                    kind, playerID, start, end, attacks = unpack_action(action)
+                    self.assertIn(kind, (ACTION_PLACE, ACTION_MOVE, ACTION_JUMP))
+                    self.assertEqual(playerID, g.player_turn.playerID)
+                    self.assertEqual(attacks & ~g.board.bb[1 - playerID], 0)
+                g.execute(rand.choice(actions))
+            self.assertEqual(len(rollout_state(g, 0, 20, random_buffer(random_generator(7), 2, 20))), 2)
+
+    def test_too_many_fields(self):
+        GameState(sides=42)  # 252 fields
+        with self.assertRaises(ValueError):
+            GameState(sides=43)  # 258 fields, more than the 8 bit fields of the actions address
+
+
+class TestRollout(unittest.TestCase):
+
+    def test_combinations(self):
+        mask = 0b1011_0010_0110
+        bits = [n for n in range(12) if (mask >> n) & 1]
+        for m in range(1, 4):
+            expected = sorted(sum(1 << b for b in comb) for comb in itertools.combinations(bits, m))
+            subsets = []
+            sub = (1 << m) - 1
+            while sub < 1 << len(bits):
+                subsets.append(deposit_bits(sub, mask))
+                sub = next_combination(sub)
+            self.assertEqual(subsets, expected)
+            self.assertEqual([nth_combination(mask, m, k) for k in range(binomial(len(bits), m))], expected)
+
+    def test_rollout_matches_game_rules(self):
+        policy = SimpleSimulationPolicy(0)
+        for seed in range(40):
+            rand = random.Random(seed)
+            for sides in range(3, 5):
+                g = GameState(sides=sides)
+                for _ in range(rand.randrange(0, 40)):
+                    actions = list(g.calc_available_actions())
+                    if not actions:
+                        break
+                    g.execute(rand.choice(actions))
+
+                numbers = random_buffer(random_generator(seed), 1, policy.max_depth)
+
+                # Play the same random actions with the game rules, actions with an attack come first
+                state = g.clone()
+                steps, winner = 0, -1
+                while steps < policy.max_depth:
+                    actions = list(state.calc_available_actions())
+                    if not actions:
+                        winner = state.other(state.player_turn).playerID
+                        break
+                    actions = [a for a in actions if action_attacks(a)] or actions
+                    state.execute(actions[numbers[0][steps] % len(actions)])
+                    steps += 1
+
+                self.assertEqual(list(rollout_state(g, 0, policy.max_depth, numbers)),
+                                 [(steps, winner, *state.board.count_total())])
+
+
+class TestMCTS(unittest.TestCase):
+
+    def test_run_parallel_error(self):
+        propagated = []
+
+        class FailingSimulationPolicy(SimpleSimulationPolicy):
+            def calc_reward(self, node):
+                if node.state.ply > 1:
+                    raise RuntimeError("Simulation failed")
+                return super().calc_reward(node)
+
+        class CountingBackpropagationPolicy(SimpleBackpropagationPolicy):
+            def backpropagate(self, node, simulations, reward_total):
+                propagated.append(simulations)
+                super().backpropagate(node, simulations, reward_total)
+
+        mcts = MCTS(GameState(), SimpleSelectionPolicy(), SimpleExpansionPolicy(), FailingSimulationPolicy(0),
+                    CountingBackpropagationPolicy())
+        with self.assertRaises(RuntimeError):
+            mcts.run_parallel(4, 5.0)
+        # The virtual losses of the failed iterations are removed again
+        root = mcts.node
+        self.assertEqual(root.simulations, sum(propagated))
+        self.assertEqual(root.simulations, sum(root.child_sims[:len(root.child_nodes)]))
+
+    def test_one_simulation_per_rollout(self):
+        simulated = []
+
+        class CountingSimulationPolicy(SimpleSimulationPolicy):
+            def simulate(self, node):
+                simulated.append(node)
+                return super().simulate(node)
+
+        random.seed(3)
+        mcts = MCTS(GameState(sides=3), SimpleSelectionPolicy(), SimpleExpansionPolicy(),
+                    CountingSimulationPolicy(0, batch=1), SimpleBackpropagationPolicy())
+        for _ in range(200):
+            mcts.run_one_iteration()
+        # Nodes reached again by transposition only add their new simulation to the ancestors
+        self.assertLess(len(set(simulated)), len(simulated))
+        self.assertEqual(mcts.node.simulations, len(simulated))
+
+    def test_reproducible_with_random_seed(self):
+        rewards = []
+        for _ in range(2):
+            random.seed(1)
+            mcts = init_mcts(GameState(), 0)
+            for _ in range(50):
+                mcts.run_one_iteration()
+            rewards.append((mcts.node.simulations, mcts.node.reward_total))
+        self.assertEqual(rewards[0], rewards[1])
+
+    def test_run_parallel(self):
+        mcts = init_mcts(GameState(), 0)
+        self.assertGreater(mcts.run_parallel(4, 0.5), 0)
+        # All virtual losses are removed again
+        root = mcts.node
+        n = len(root.child_nodes)
+        self.assertEqual(root.simulations, sum(root.child_sims[:n]))
+        self.assertGreater(root.simulations, 0)
+        for child in root.child_nodes:
+            self.assertIs(child.parent, root)